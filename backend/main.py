@@ -1,11 +1,28 @@
 from fastapi import FastAPI, HTTPException
 import logging
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from groq import Groq
+from groq import AsyncGroq, APIConnectionError, InternalServerError, RateLimitError
+from fastembed import TextEmbedding
+from cachetools import TTLCache
+import redis.asyncio as aioredis
+from redis.exceptions import LockNotOwnedError
+import tiktoken
+from celery.result import AsyncResult
+from tasks import celery_app, brainstorm_task
+import numpy as np
+import asyncio
+import contextlib
+import functools
+import hashlib
+import json
 import os
-import uuid
-from typing import List, Dict, Optional
+import re
+import secrets
+import time
+from collections import deque
+from typing import Deque, List, Dict, Optional, Tuple
 
 # Configuration du logging AVANT tout
 logging.basicConfig(
@@ -14,39 +31,626 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Think-Space API")
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Arrêt : fermeture du pool de connexions Redis
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+app = FastAPI(title="Think-Space API", lifespan=lifespan)
 
 # Configuration CORS
+# Liste fixe d'origines autorisées (séparées par des virgules dans CORS_ORIGINS).
+# max_age permet au navigateur de garder la réponse preflight en cache 24h.
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "http://localhost:8080,http://127.0.0.1:8080,http://localhost:5173").split(",")
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], # Le "*" signifie "Autoriser tout le monde" (parfait pour ton rendu)
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+    max_age=86400,
 )
 
-# Initialisation du client Groq
+# Initialisation du client Groq (asynchrone pour ne pas bloquer la boucle d'événements)
 API_KEY_ENV = "GROQ_API_KEY"
 api_key = os.getenv(API_KEY_ENV)
 
-logger.info(f"API Key présente: {bool(api_key)}")
+# Modèle résolu une seule fois au démarrage
+MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
+# Timeout (s) et nombre de nouvelles tentatives de chaque appel Groq
+GROQ_TIMEOUT = 60
+GROQ_MAX_RETRIES = 2
+
+logger.info("API Key présente: %s", bool(api_key))
 
 if not api_key:
     client = None
     logger.warning(" Pas de clé API Groq trouvée!")
 else:
     try:
-        client = Groq(api_key=api_key)
-        logger.info(" Client Groq initialisé avec succès")
+        client = AsyncGroq(api_key=api_key, timeout=GROQ_TIMEOUT, max_retries=GROQ_MAX_RETRIES)
+        logger.info(" Client Groq initialisé avec succès (modèle: %s)", MODEL)
     except Exception as e:
         client = None
-        logger.error(f" Erreur lors de l'initialisation du client Groq: {e}")
+        logger.error(" Erreur lors de l'initialisation du client Groq: %s", e)
 
 
 # ===== NOUVEAU : SYSTÈME DE GESTION DE SESSIONS =====
-# Dictionnaire pour stocker les conversations en mémoire
+# Si REDIS_URL est défini, les conversations sont stockées dans Redis
+# (liste "session:{id}" de messages JSON) et partagées entre tous les
+# workers uvicorn. Sinon, elles restent dans un cache borné en mémoire :
+# au-delà de SESSION_MAX_COUNT sessions, les plus anciennes sont évincées.
+# Dans les deux cas, une session inactive depuis SESSION_TTL secondes expire.
 # Structure: {session_id: [{"role": "user", "content": "..."}, ...]}
-conversations: Dict[str, List[Dict[str, str]]] = {}
+SESSION_MAX_COUNT = 10_000
+SESSION_TTL = 3600
+# Nombre maximum d'échanges (user + assistant) envoyés à Groq
+MAX_HISTORY_TURNS = 20
+# Budget de tokens de l'historique envoyé à Groq (hors prompt système)
+MAX_HISTORY_TOKENS = int(os.getenv("MAX_HISTORY_TOKENS", "4000"))
+
+# Durée max de détention du verrou Redis d'une session : attente du limiteur
+# de débit (60 s max) + pire cas des tentatives Groq (timeout + backoff).
+# Pendant un streaming, le verrou est prolongé tant que des tokens arrivent.
+SESSION_LOCK_TIMEOUT = 60 + (GROQ_MAX_RETRIES + 1) * (GROQ_TIMEOUT + 10)
+
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = (
+    aioredis.Redis.from_url(REDIS_URL, max_connections=20, decode_responses=True)
+    if REDIS_URL else None
+)
+logger.info(" Stockage des sessions: %s", "Redis" if redis_client is not None else "mémoire")
+
+conversations: TTLCache = TTLCache(maxsize=SESSION_MAX_COUNT, ttl=SESSION_TTL)
+# Un verrou par session : deux requêtes simultanées sur la même conversation
+# sont traitées l'une après l'autre, pour garder une alternance user/assistant.
+# Les verrous expirent avec les sessions.
+session_locks: TTLCache = TTLCache(maxsize=SESSION_MAX_COUNT, ttl=SESSION_TTL)
+
+
+def session_key(session_id: str) -> str:
+    return f"session:{session_id}"
+
+
+@contextlib.asynccontextmanager
+async def get_session_lock(session_id: str):
+    """Verrouille la session (verrou partagé entre workers si Redis est configuré).
+
+    Renvoie un objet à passer à extend_session_lock pour les tours longs.
+    """
+    if redis_client is None:
+        lock = session_locks.get(session_id) or asyncio.Lock()
+        # Réinsérer le verrou repousse son expiration
+        session_locks[session_id] = lock
+        async with lock:
+            yield lock
+        return
+    
+    lock = redis_client.lock(f"lock:{session_key(session_id)}", timeout=SESSION_LOCK_TIMEOUT, sleep=0.05)
+    await lock.acquire()
+    try:
+        yield lock
+    finally:
+        try:
+            await lock.release()
+        except LockNotOwnedError:
+            # Le tour a dépassé SESSION_LOCK_TIMEOUT : la réponse est déjà
+            # enregistrée, on ne la transforme pas en erreur 500
+            logger.warning(" Verrou de session %s expiré avant la fin du tour", session_id)
+
+
+async def extend_session_lock(lock):
+    """Repousse l'expiration d'un verrou Redis de session (sans effet en mémoire)"""
+    if not isinstance(lock, asyncio.Lock):
+        await lock.extend(SESSION_LOCK_TIMEOUT, replace_ttl=True)
+
+
+async def append_message(session_id: str, message: Dict[str, str]) -> List[Dict[str, str]]:
+    """Ajoute un message, repousse l'expiration de la session et retourne l'historique"""
+    if redis_client is not None:
+        key = session_key(session_id)
+        # Un seul aller-retour : ajout, troncature, expiration et relecture
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, json.dumps(message, ensure_ascii=False))
+            pipe.ltrim(key, -2 * MAX_HISTORY_TURNS, -1)
+            pipe.expire(key, SESSION_TTL)
+            pipe.lrange(key, 0, -1)
+            *_, raw = await pipe.execute()
+        return [json.loads(item) for item in raw]
+    
+    history = conversations.get(session_id, [])
+    history.append(message)
+    # Même troncature que LTRIM côté Redis
+    del history[:-2 * MAX_HISTORY_TURNS]
+    # Réinsérer la liste remet à zéro son TTL dans le cache
+    conversations[session_id] = history
+    return history
+
+
+async def delete_session(session_id: str) -> bool:
+    """Efface l'historique d'une session ; retourne False si elle n'existait pas"""
+    if redis_client is not None:
+        return bool(await redis_client.delete(session_key(session_id)))
+    return conversations.pop(session_id, None) is not None
+
+
+async def count_sessions() -> Optional[int]:
+    if redis_client is not None:
+        # Non calculé avec Redis : compter les clés imposerait un SCAN de toute
+        # la base à chaque health check
+        return None
+    return len(conversations)
+
+
+# Tokenizer approximatif (cl100k) : Llama n'a pas d'encodage tiktoken, mais
+# l'ordre de grandeur suffit pour borner le coût d'une requête.
+# L'image Docker le pré-télécharge dans TIKTOKEN_CACHE_DIR.
+try:
+    encoding = tiktoken.get_encoding("cl100k_base")
+except Exception as e:
+    encoding = None
+    logger.warning(" Tokenizer indisponible, estimation à 4 caractères/token: %s", e)
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def recent_history(history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Fenêtre glissante de l'historique envoyé à Groq.
+
+    Garde au plus MAX_HISTORY_TURNS échanges et MAX_HISTORY_TOKENS tokens, en
+    retirant les plus anciens par paires user/assistant pour conserver
+    l'alternance. Le dernier message utilisateur est toujours conservé.
+    """
+    window = history[-2 * MAX_HISTORY_TURNS:]
+    while window and window[0]["role"] != "user":
+        window = window[1:]
+    
+    total = sum(count_tokens(message["content"]) for message in window)
+    while total > MAX_HISTORY_TOKENS and len(window) > 1:
+        drop = 2 if window[1]["role"] == "assistant" else 1
+        total -= sum(count_tokens(message["content"]) for message in window[:drop])
+        window = window[drop:]
+    return window
+
+
+# ===== CACHE SÉMANTIQUE DES RÉPONSES =====
+# Si un premier message est quasi identique (similarité cosinus >= seuil)
+# à un prompt déjà traité, on renvoie la réponse stockée sans appeler Groq.
+# Seuls les débuts de conversation sont mis en cache : ensuite, la réponse
+# dépend de l'historique de la session. Les prompts longs (dont les demandes
+# de roadmap, qui embarquent toute la conversation) sont exclus : le modèle
+# d'embedding les tronquerait et confondrait des contextes différents.
+# Modèle multilingue : les prompts sont en français.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+# Dossier des modèles téléchargés (pré-rempli dans l'image Docker)
+FASTEMBED_CACHE_DIR = os.getenv("FASTEMBED_CACHE_PATH")
+# Longueur max (en tokens) des prompts mis en cache, sous la limite du modèle
+SEMANTIC_CACHE_MAX_PROMPT_TOKENS = 100
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_MAX_ENTRIES = 1000
+
+try:
+    embedder = TextEmbedding(model_name=EMBEDDING_MODEL, cache_dir=FASTEMBED_CACHE_DIR)
+    logger.info(" Modèle d'embedding chargé: %s", EMBEDDING_MODEL)
+except Exception as e:
+    embedder = None
+    logger.warning(" Cache sémantique désactivé (embedding indisponible): %s", e)
+
+
+class DynamicBatcher:
+    """Regroupe les appels concurrents pour traiter plusieurs éléments en un seul lot.
+
+    Chaque appelant attend son propre résultat ; un lot part dès que max_batch
+    éléments sont en attente ou que max_wait_ms s'est écoulé depuis le premier.
+    """
+
+    def __init__(self, func, max_batch: int = 32, max_wait_ms: float = 10):
+        self.func = func
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, item):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            items = [item for item, _ in batch]
+            try:
+                # func est synchrone (calcul CPU) : exécutée hors de la boucle
+                results = await asyncio.to_thread(self.func, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+def embed_batch(prompts: List[str]) -> List[np.ndarray]:
+    """Calcule les embeddings normalisés d'un lot de prompts"""
+    vectors = np.asarray(list(embedder.embed(prompts)), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return list(vectors)
+
+
+embedding_batcher = DynamicBatcher(embed_batch, max_batch=32, max_wait_ms=10)
+
+
+async def embed_prompt(prompt: str) -> np.ndarray:
+    """Calcule l'embedding normalisé d'un prompt (regroupé avec les requêtes concurrentes)"""
+    return await embedding_batcher.submit(prompt)
+
+
+class SemanticCache:
+    """Index en mémoire (produit scalaire sur vecteurs normalisés) des réponses passées"""
+
+    def __init__(self, threshold: float, ttl: int, max_entries: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._vectors: Optional[np.ndarray] = None
+        # Structure: [(prompt, response, created_at), ...] aligné sur self._vectors
+        self._entries: List[Tuple[str, str, float]] = []
+        self._lock = asyncio.Lock()
+
+    def _evict(self, now: float):
+        keep = [i for i, (_, _, created_at) in enumerate(self._entries)
+                if now - created_at < self.ttl]
+        keep = keep[-self.max_entries:]
+        if len(keep) != len(self._entries):
+            self._entries = [self._entries[i] for i in keep]
+            self._vectors = self._vectors[keep] if keep else None
+
+    async def lookup(self, vector: np.ndarray) -> Optional[str]:
+        async with self._lock:
+            self._evict(time.monotonic())
+            if self._vectors is None:
+                return None
+            scores = self._vectors @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return self._entries[best][1]
+            return None
+
+    async def store(self, prompt: str, vector: np.ndarray, response: str):
+        async with self._lock:
+            now = time.monotonic()
+            self._entries.append((prompt, response, now))
+            row = vector[np.newaxis, :]
+            self._vectors = row if self._vectors is None else np.vstack([self._vectors, row])
+            self._evict(now)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_ENTRIES)
+
+
+# ===== LIMITATION DE DÉBIT VERS GROQ =====
+# Fenêtre glissante sur 60 s (RPM) + concurrence adaptative AIMD :
+# chaque 429 divise par deux le nombre d'appels simultanés autorisés,
+# chaque succès le ré-augmente de 0.5 jusqu'à GROQ_MAX_CONCURRENCY.
+GROQ_RPM_LIMIT = int(os.getenv("GROQ_RPM_LIMIT", "30"))
+GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", "8"))
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Convertit une durée Groq ("7.66s", "2m59.56s", "120ms") ou un nombre en secondes"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+class AdaptiveRateLimiter:
+    """Régule les appels sortants vers Groq (à utiliser avec `async with`)"""
+
+    def __init__(self, rpm_limit: int, max_concurrency: int):
+        self.rpm_limit = rpm_limit
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self._active = 0
+        self._window: Deque[float] = deque()
+        self._blocked_until = 0.0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < max(1, int(self.concurrency)))
+            self._active += 1
+        try:
+            await self._wait_for_window()
+        except BaseException:
+            await self._release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._release()
+
+    async def _release(self):
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    async def _wait_for_window(self):
+        while True:
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= 60:
+                self._window.popleft()
+            delay = self._blocked_until - now
+            if len(self._window) >= self.rpm_limit:
+                delay = max(delay, self._window[0] + 60 - now)
+            if delay <= 0:
+                self._window.append(now)
+                return
+            logger.info(" Limite de débit Groq atteinte, attente de %.1fs", delay)
+            await asyncio.sleep(delay)
+
+    def record_success(self, headers=None):
+        self.concurrency = min(float(self.max_concurrency), self.concurrency + 0.5)
+        if headers is not None and headers.get("x-ratelimit-remaining-requests") == "0":
+            reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+            if reset:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + reset)
+
+    def record_rate_limited(self, retry_after: Optional[float]):
+        self.concurrency = max(1.0, self.concurrency * 0.5)
+        if retry_after is not None:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        logger.warning(" 429 Groq: concurrence réduite à %.1f", self.concurrency)
+
+
+rate_limiter = AdaptiveRateLimiter(GROQ_RPM_LIMIT, GROQ_MAX_CONCURRENCY)
+
+
+# ===== DISJONCTEUR (CIRCUIT BREAKER) =====
+# Après CIRCUIT_FAILURE_THRESHOLD pannes consécutives de Groq (5xx, réseau,
+# timeout), le circuit s'ouvre : les requêtes échouent immédiatement en 503
+# pendant CIRCUIT_RECOVERY_TIMEOUT secondes, puis une seule requête de test
+# est autorisée pour décider de refermer le circuit.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RECOVERY_TIMEOUT = 60
+
+
+class CircuitOpenError(Exception):
+    """Levée quand le disjoncteur refuse un appel vers Groq"""
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float, failure_types: tuple):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failure_types = failure_types
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_lock = asyncio.Lock()
+
+    def retry_after(self) -> int:
+        return max(1, int(self.opened_at + self.recovery_timeout - time.monotonic()))
+
+    async def call(self, func, *args, **kwargs):
+        async with self.guard():
+            return await func(*args, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def guard(self):
+        """Protège un bloc entier (ex : lecture complète d'un flux) par le disjoncteur"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                raise CircuitOpenError()
+            self.state = self.HALF_OPEN
+            logger.info(" Disjoncteur semi-ouvert: requête de test vers Groq")
+        if self.state == self.HALF_OPEN:
+            if self._probe_lock.locked():
+                raise CircuitOpenError()
+            async with self._probe_lock:
+                async with self._attempt():
+                    yield
+            return
+        async with self._attempt():
+            yield
+
+    @contextlib.asynccontextmanager
+    async def _attempt(self):
+        try:
+            yield
+        except self.failure_types:
+            self._record_failure()
+            raise
+        except Exception:
+            # Groq a répondu (4xx, 429...) : le service est joignable
+            self._record_success()
+            raise
+        self._record_success()
+
+    def _record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(" Disjoncteur refermé")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def _record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            logger.warning(" Disjoncteur ouvert après %d échecs consécutifs", self.failures)
+
+
+circuit_breaker = CircuitBreaker(
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_RECOVERY_TIMEOUT,
+    (APIConnectionError, InternalServerError)
+)
+
+
+# ===== COALESCENCE DES REQUÊTES IDENTIQUES (SINGLE-FLIGHT) =====
+# Deux requêtes identiques (même modèle, mêmes messages) arrivant en même
+# temps ne déclenchent qu'un seul appel Groq : la seconde attend le résultat
+# de la première.
+inflight: Dict[str, asyncio.Task] = {}
+
+
+def request_key(model: str, messages: List[Dict[str, str]]) -> str:
+    payload = json.dumps([model, messages], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def forget_inflight(key: str, task: asyncio.Task):
+    if inflight.get(key) is task:
+        del inflight[key]
+    # Marque l'exception comme lue s'il n'y a plus aucun appelant
+    if not task.cancelled():
+        task.exception()
+
+
+async def single_flight(key: str, func):
+    """Exécute func() une seule fois pour toutes les requêtes concurrentes de même clé.
+
+    L'appel tourne dans sa propre tâche : si le client qui l'a déclenché se
+    déconnecte, les autres appelants reçoivent quand même le résultat.
+    """
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(func())
+        inflight[key] = task
+        task.add_done_callback(functools.partial(forget_inflight, key))
+    else:
+        logger.info(" Requête identique déjà en cours, réutilisation du résultat")
+    return await asyncio.shield(task)
+
+
+# ===== FILE DE TÂCHES CELERY (OPTIONNELLE) =====
+# Si CELERY_BROKER_URL est défini, /brainstorm/async délègue l'appel Groq à un
+# worker Celery et renvoie immédiatement un task_id à interroger via
+# GET /brainstorm/{task_id}.
+# Tant que la réponse d'une tâche n'est pas enregistrée, la session est
+# marquée "en attente" : le tour suivant récupère d'abord cette réponse, ou
+# est refusé (409) si elle n'est pas encore prête, pour garder l'alternance.
+CELERY_ENABLED = bool(os.getenv("CELERY_BROKER_URL"))
+# Structure: {task_id: (session_id, prompt, embedding du prompt)}
+pending_tasks: TTLCache = TTLCache(maxsize=SESSION_MAX_COUNT, ttl=SESSION_TTL)
+# Structure: {session_id: task_id}
+pending_sessions: TTLCache = TTLCache(maxsize=SESSION_MAX_COUNT, ttl=SESSION_TTL)
+
+
+async def store_pending_task(task_id: str, session_id: str, prompt: str, prompt_vector: Optional[np.ndarray]):
+    if redis_client is not None:
+        entry = {
+            "session_id": session_id,
+            "prompt": prompt,
+            "prompt_vector": prompt_vector.tolist() if prompt_vector is not None else None
+        }
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(f"task:{task_id}", json.dumps(entry), ex=SESSION_TTL)
+            pipe.set(f"pending:{session_id}", task_id, ex=SESSION_TTL)
+            await pipe.execute()
+        return
+    pending_tasks[task_id] = (session_id, prompt, prompt_vector)
+    pending_sessions[session_id] = task_id
+
+
+def decode_pending_task(raw: Optional[str]) -> Optional[Tuple[str, str, Optional[np.ndarray]]]:
+    if raw is None:
+        return None
+    entry = json.loads(raw)
+    vector = entry["prompt_vector"]
+    return (
+        entry["session_id"],
+        entry["prompt"],
+        np.asarray(vector, dtype=np.float32) if vector is not None else None
+    )
+
+
+async def load_pending_task(task_id: str) -> Optional[Tuple[str, str, Optional[np.ndarray]]]:
+    if redis_client is not None:
+        return decode_pending_task(await redis_client.get(f"task:{task_id}"))
+    return pending_tasks.get(task_id)
+
+
+async def pop_pending_task(task_id: str) -> Optional[Tuple[str, str, Optional[np.ndarray]]]:
+    """Retire une tâche en attente et libère sa session (une seule fois, même entre workers)"""
+    if redis_client is not None:
+        pending = decode_pending_task(await redis_client.getdel(f"task:{task_id}"))
+        if pending is not None:
+            await redis_client.delete(f"pending:{pending[0]}")
+        return pending
+    pending = pending_tasks.pop(task_id, None)
+    if pending is not None:
+        pending_sessions.pop(pending[0], None)
+    return pending
+
+
+async def get_pending_task_id(session_id: str) -> Optional[str]:
+    if redis_client is not None:
+        return await redis_client.get(f"pending:{session_id}")
+    return pending_sessions.get(session_id)
+
+
+async def settle_task(task_id: str) -> str:
+    """Enregistre la réponse d'une tâche terminée dans l'historique (une seule fois).
+
+    À appeler sous le verrou de la session. Retourne l'état Celery de la tâche.
+    """
+    result = AsyncResult(task_id, app=celery_app)
+    state = await asyncio.to_thread(lambda: result.state)
+    if state not in ("SUCCESS", "FAILURE"):
+        return state
+    
+    pending = await pop_pending_task(task_id)
+    if pending is not None and state == "SUCCESS":
+        session_id, prompt, prompt_vector = pending
+        await finish_turn(session_id, prompt, prompt_vector, result.result)
+    return state
 
 
 class Query(BaseModel):
@@ -54,6 +658,19 @@ class Query(BaseModel):
     session_id: Optional[str] = None  # ID de session optionnel
 
 
+# Modèles de réponse : FastAPI les sérialise directement en JSON via Pydantic
+class BrainstormResponse(BaseModel):
+    response: str
+    session_id: str
+
+
+class TaskResponse(BaseModel):
+    status: str  # "pending" ou "done"
+    task_id: Optional[str] = None
+    response: Optional[str] = None
+    session_id: Optional[str] = None
+
+
 SYSTEM_PROMPT = """
 
 Tu es **Think-Space**, une IA spécialisée EXCLUSIVEMENT dans :
@@ -211,12 +828,33 @@ Si NON → rejette l'idée.
 
 Lorsque la réponse est fournie :
 > « Dis-moi lequel de ces axes tu veux approfondir ou si tu veux changer de problème. »
-"""
-
-
-@app.post("/brainstorm")
-async def brainstorm(query: Query):
-    logger.info(f" Requête reçue: {query.prompt[:50]}...")
+""".strip()
+# Le prompt système doit rester STRICTEMENT identique d'une requête à l'autre
+# et toujours être le premier message : Groq réutilise alors le préfixe déjà
+# calculé (prompt caching). Ne jamais y interpoler de contenu dynamique.
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+def log_prompt_cache_usage(completion):
+    """Trace les tokens du prompt et la part servie par le cache de préfixe Groq.
+
+    Accepte une réponse complète ou un fragment de flux (seul le dernier
+    fragment porte l'usage, dans x_groq.usage).
+    """
+    x_groq_usage = getattr(getattr(completion, "x_groq", None), "usage", None)
+    usage = getattr(completion, "usage", None) or x_groq_usage
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None)
+    if cached_tokens is None:
+        cached_tokens = getattr(x_groq_usage, "cached_tokens", 0) or 0
+    logger.info(" Tokens prompt: %s (dont %s en cache)", usage.prompt_tokens, cached_tokens)
+
+
+def resolve_session(query: Query) -> str:
+    """Vérifie que le client Groq est prêt et retourne le session_id (créé au besoin)"""
+    logger.info(" Requête reçue: %s...", query.prompt[:50])
     
     if client is None:
         logger.error("Client Groq non initialisé")
@@ -228,97 +866,359 @@ async def brainstorm(query: Query):
     # Récupérer ou créer un session_id
     session_id = query.session_id
     if not session_id:
-        session_id = str(uuid.uuid4())
-        logger.info(f" Nouvelle session créée: {session_id}")
-    
-    # Initialiser l'historique si la session n'existe pas
-    if session_id not in conversations:
-        conversations[session_id] = []
-        logger.info(f" Nouvelle conversation initialisée pour session: {session_id}")
+        session_id = secrets.token_urlsafe(16)
+        logger.info(" Nouvelle session créée: %s", session_id)
+    return session_id
+
+
+async def start_turn(session_id: str, prompt: str) -> Tuple[List[Dict[str, str]], Optional[np.ndarray], Optional[str]]:
+    """Enregistre le message utilisateur et consulte le cache sémantique.
+
+    À appeler sous le verrou de la session.
+    Retourne (historique, embedding du prompt, réponse en cache).
+    """
+    # Réponse d'une tâche Celery encore non enregistrée pour cette session
+    task_id = await get_pending_task_id(session_id)
+    if task_id is not None and await settle_task(task_id) not in ("SUCCESS", "FAILURE"):
+        raise HTTPException(
+            status_code=409,
+            detail="Une réponse est encore en cours de génération pour cette session, réessaie dans quelques instants."
+        )
     
     # Ajouter le message utilisateur à l'historique
-    conversations[session_id].append({
+    history = await append_message(session_id, {
         "role": "user",
-        "content": query.prompt
+        "content": prompt
     })
+    if len(history) == 1:
+        logger.info(" Nouvelle conversation initialisée pour session: %s", session_id)
     
-    logger.info(f" Historique actuel: {len(conversations[session_id])} messages")
+    logger.info(" Historique actuel: %d messages", len(history))
     
-    MODEL_ENV = "GROQ_MODEL"
-    model = os.getenv(MODEL_ENV, "llama-3.3-70b-versatile")
-    logger.info(f" Utilisation du modèle: {model}")
+    # Cache sémantique : uniquement pour le premier message d'une conversation
+    prompt_vector = None
+    cached = None
+    if (embedder is not None and len(history) == 1
+            and not session_id.endswith("_roadmap")
+            and count_tokens(prompt) <= SEMANTIC_CACHE_MAX_PROMPT_TOKENS):
+        try:
+            prompt_vector = await embed_prompt(prompt)
+            cached = await semantic_cache.lookup(prompt_vector)
+        except Exception as e:
+            prompt_vector = None
+            cached = None
+            logger.warning(" Cache sémantique ignoré: %s", e)
+        if cached is not None:
+            logger.info(" Réponse servie depuis le cache sémantique")
+            await append_message(session_id, {
+                "role": "assistant",
+                "content": cached
+            })
     
-    try:
-        logger.info(" Envoi de la requête à Groq...")
-        
-        # Construire les messages avec le système + historique complet
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT}
-        ] + conversations[session_id]  # ← TOUTE la conversation
-        
-        completion = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.8,
-            max_tokens=1024
+    return history, prompt_vector, cached
+
+
+async def finish_turn(session_id: str, prompt: str, prompt_vector: Optional[np.ndarray], resp: str):
+    """Met en cache la réponse et l'ajoute à l'historique de la session"""
+    logger.info(" Réponse reçue: %d caractères", len(resp))
+    
+    if prompt_vector is not None:
+        await semantic_cache.store(prompt, prompt_vector, resp)
+    
+    # Ajouter la réponse de l'assistant à l'historique
+    await append_message(session_id, {
+        "role": "assistant",
+        "content": resp
+    })
+
+
+def record_rate_limit(e: RateLimitError):
+    # Appelé là où l'appel Groq est fait : une seule fois par 429, même si la
+    # même erreur est renvoyée à plusieurs requêtes coalescées
+    rate_limiter.record_rate_limited(parse_duration(e.response.headers.get("retry-after")))
+
+
+async def create_completion(history: List[Dict[str, str]]):
+    """Appelle Groq derrière le disjoncteur et le limiteur de débit"""
+    logger.info(" Envoi de la requête à Groq...")
+    
+    # Construire les messages : préfixe système fixe + derniers échanges
+    messages = [SYSTEM_MESSAGE, *recent_history(history)]
+    
+    async def call_groq():
+        async with rate_limiter:
+            try:
+                return await client.chat.completions.with_raw_response.create(
+                    model=MODEL,
+                    messages=messages,
+                    temperature=0.8,
+                    max_tokens=1024
+                )
+            except RateLimitError as e:
+                record_rate_limit(e)
+                raise
+    
+    async def call_and_parse():
+        raw = await circuit_breaker.call(call_groq)
+        rate_limiter.record_success(raw.headers)
+        return await raw.parse()
+    
+    return await single_flight(request_key(MODEL, messages), call_and_parse)
+
+
+@contextlib.asynccontextmanager
+async def open_completion_stream(history: List[Dict[str, str]]):
+    """Ouvre un flux Groq (non coalescé : un flux ne se partage pas).
+
+    Le créneau du limiteur de débit et la requête de test du disjoncteur
+    restent pris jusqu'à la fin de la lecture ; les erreurs survenues en cours
+    de flux sont comptabilisées, et le flux est toujours fermé.
+    """
+    logger.info(" Envoi de la requête à Groq (streaming)...")
+    messages = [SYSTEM_MESSAGE, *recent_history(history)]
+    
+    async with circuit_breaker.guard(), rate_limiter:
+        try:
+            raw = await client.chat.completions.with_raw_response.create(
+                model=MODEL,
+                messages=messages,
+                temperature=0.8,
+                max_tokens=1024,
+                stream=True
+            )
+            rate_limiter.record_success(raw.headers)
+            stream = await raw.parse()
+            try:
+                yield stream
+            finally:
+                # Ferme la connexion Groq, y compris si le client s'est déconnecté
+                await stream.close()
+        except RateLimitError as e:
+            record_rate_limit(e)
+            raise
+
+
+def groq_http_error(e: Exception) -> HTTPException:
+    """Traduit une erreur d'appel Groq en réponse HTTP"""
+    if isinstance(e, CircuitOpenError):
+        logger.warning(" Appel Groq court-circuité (disjoncteur ouvert)")
+        return HTTPException(
+            status_code=503,
+            detail="Service IA temporairement indisponible, réessaie plus tard.",
+            headers={"Retry-After": str(circuit_breaker.retry_after())}
         )
+    
+    if isinstance(e, RateLimitError):
+        retry_after = parse_duration(e.response.headers.get("retry-after"))
+        return HTTPException(
+            status_code=429,
+            detail="Trop de requêtes vers le modèle, réessaie dans quelques instants.",
+            headers={"Retry-After": str(10 if retry_after is None else int(retry_after))}
+        )
+    
+    logger.exception(" ERREUR COMPLÈTE:")
+    err_str = str(e)
+    
+    if "model" in err_str.lower() and ("not found" in err_str.lower() or "decommissioned" in err_str.lower()):
+        return HTTPException(
+            status_code=400, 
+            detail=f"Modèle '{MODEL}' non disponible. Erreur: {err_str}"
+        )
+    
+    return HTTPException(
+        status_code=500, 
+        detail=f"Erreur serveur: {err_str}"
+    )
+
+
+def sse_event(payload) -> str:
+    """Formate un événement Server-Sent Events"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.post("/brainstorm", response_model=BrainstormResponse)
+async def brainstorm(query: Query):
+    session_id = resolve_session(query)
+    
+    async with get_session_lock(session_id):
+        history, prompt_vector, cached = await start_turn(session_id, query.prompt)
+        if cached is not None:
+            return {
+                "response": cached,
+                "session_id": session_id
+            }
         
-        # Extraction de la réponse
-        resp = completion.choices[0].message.content
-        logger.info(f" Réponse reçue: {len(resp)} caractères")
-        
-        # Ajouter la réponse de l'assistant à l'historique
-        conversations[session_id].append({
-            "role": "assistant",
-            "content": resp
-        })
-        
-        return {
-            "response": resp,
-            "session_id": session_id
-        }
-        
-    except Exception as e:
-        logger.exception(" ERREUR COMPLÈTE:")
-        err_str = str(e)
+        try:
+            completion = await create_completion(history)
+            
+            # Extraction de la réponse
+            resp = completion.choices[0].message.content
+            log_prompt_cache_usage(completion)
+            await finish_turn(session_id, query.prompt, prompt_vector, resp)
+            
+            return {
+                "response": resp,
+                "session_id": session_id
+            }
+            
+        except Exception as e:
+            raise groq_http_error(e)
+
+
+@app.post("/brainstorm/stream")
+async def brainstorm_stream(query: Query):
+    """Variante de /brainstorm qui renvoie les tokens au fil de l'eau (SSE).
+
+    Événements : {"session_id": ...}, puis {"delta": ...} pour chaque fragment,
+    {"error": ...} en cas d'échec, et enfin [DONE].
+    """
+    session_id = resolve_session(query)
+    
+    async def generate():
+        yield sse_event({"session_id": session_id})
+        # Le verrou est pris dans le générateur pour être relâché même si le
+        # client se déconnecte avant la fin du flux
+        async with get_session_lock(session_id) as lock:
+            try:
+                history, prompt_vector, cached = await start_turn(session_id, query.prompt)
+            except HTTPException as e:
+                yield sse_event({"error": e.detail})
+                return
+            if cached is not None:
+                yield sse_event({"delta": cached})
+                yield "data: [DONE]\n\n"
+                return
+            
+            parts = []
+            try:
+                async with open_completion_stream(history) as stream:
+                    extended_at = time.monotonic()
+                    async for chunk in stream:
+                        if time.monotonic() - extended_at > SESSION_LOCK_TIMEOUT / 3:
+                            await extend_session_lock(lock)
+                            extended_at = time.monotonic()
+                        log_prompt_cache_usage(chunk)
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            parts.append(delta)
+                            yield sse_event({"delta": delta})
+            except Exception as e:
+                yield sse_event({"error": groq_http_error(e).detail})
+                return
+            await finish_turn(session_id, query.prompt, prompt_vector, "".join(parts))
+        yield "data: [DONE]\n\n"
+    
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/brainstorm/async", response_model=TaskResponse)
+async def brainstorm_async(query: Query):
+    """Variante de /brainstorm qui place l'appel Groq dans la file Celery"""
+    if not CELERY_ENABLED:
+        raise HTTPException(
+            status_code=503,
+            detail="File de tâches non configurée: set environment variable CELERY_BROKER_URL"
+        )
+    
+    session_id = resolve_session(query)
+    
+    # Le verrou couvre l'ajout du message et la mise en file ; la réponse est
+    # ajoutée à l'historique par le premier appel à GET /brainstorm/{task_id}
+    # ou, à défaut, au début du tour suivant
+    async with get_session_lock(session_id):
+        history, prompt_vector, cached = await start_turn(session_id, query.prompt)
+        if cached is not None:
+            return {
+                "status": "done",
+                "response": cached,
+                "session_id": session_id
+            }
         
-        if "model" in err_str.lower() and ("not found" in err_str.lower() or "decommissioned" in err_str.lower()):
+        messages = [SYSTEM_MESSAGE, *recent_history(history)]
+        task = await asyncio.to_thread(brainstorm_task.delay, messages)
+        await store_pending_task(task.id, session_id, query.prompt, prompt_vector)
+        logger.info(" Tâche Celery %s créée pour session: %s", task.id, session_id)
+    
+    return {
+        "status": "pending",
+        "task_id": task.id,
+        "session_id": session_id
+    }
+
+
+@app.get("/brainstorm/{task_id}", response_model=TaskResponse)
+async def brainstorm_result(task_id: str):
+    """Interroge l'état d'une tâche créée par /brainstorm/async"""
+    if not CELERY_ENABLED:
+        raise HTTPException(
+            status_code=503,
+            detail="File de tâches non configurée: set environment variable CELERY_BROKER_URL"
+        )
+    
+    result = AsyncResult(task_id, app=celery_app)
+    state = await asyncio.to_thread(lambda: result.state)
+    if state not in ("SUCCESS", "FAILURE"):
+        return {"status": "pending", "task_id": task_id}
+    
+    pending = await load_pending_task(task_id)
+    session_id = pending[0] if pending is not None else None
+    if session_id is not None:
+        async with get_session_lock(session_id):
+            await settle_task(task_id)
+    
+    if state == "FAILURE":
+        # Disjoncteur partagé des workers ouvert : même réponse que les endpoints directs
+        # (comparaison par nom, l'exception étant reconstruite depuis le backend)
+        if type(result.result).__name__ == "CircuitOpenError":
             raise HTTPException(
-                status_code=400, 
-                detail=f"Modèle '{model}' non disponible. Erreur: {err_str}"
+                status_code=503,
+                detail="Service IA temporairement indisponible, réessaie plus tard.",
+                headers={"Retry-After": str(CIRCUIT_RECOVERY_TIMEOUT)}
             )
-        
         raise HTTPException(
-            status_code=500, 
-            detail=f"Erreur serveur: {err_str}"
+            status_code=500,
+            detail=f"Erreur serveur: {result.result}"
         )
+    
+    return {
+        "status": "done",
+        "response": result.result,
+        "session_id": session_id
+    }
 
 
 @app.post("/clear-session")
 async def clear_session(session_id: str):
     """Endpoint pour effacer l'historique d'une session"""
-    if session_id in conversations:
-        del conversations[session_id]
-        logger.info(f" Session {session_id} effacée")
+    if await delete_session(session_id):
+        logger.info(" Session %s effacée", session_id)
         return {"message": "Session cleared"}
     return {"message": "Session not found"}
 
 
 @app.get("/")
-def health_check():
+async def health_check():
     return {
         "status": "online", 
         "model": "Groq API",
         "client_ready": client is not None,
-        "active_sessions": len(conversations)
+        "circuit_state": circuit_breaker.state,
+        "active_sessions": await count_sessions(),
+        "semantic_cache_entries": len(semantic_cache)
     }
 
 
 @app.get("/test")
-def test_endpoint():
+async def test_endpoint():
     """Endpoint de test pour vérifier que l'API fonctionne"""
     return {
         "message": "Backend fonctionne!",
         "groq_client": "initialized" if client else "missing_api_key",
-        "sessions_count": len(conversations)
+        "sessions_count": await count_sessions()
     }
\ No newline at end of file
@@ -0,0 +1,118 @@
+from celery import Celery
+from celery.exceptions import Retry
+from groq import Groq, APIConnectionError, InternalServerError, RateLimitError
+import redis
+import logging
+import os
+import time
+import uuid
+
+# Worker Celery : exécute les appels Groq hors du processus FastAPI.
+# Lancement : celery -A tasks worker --loglevel=info
+logger = logging.getLogger(__name__)
+
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", CELERY_BROKER_URL)
+MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
+GROQ_RPM_LIMIT = int(os.getenv("GROQ_RPM_LIMIT", "30"))
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RECOVERY_TIMEOUT = 60
+
+celery_app = Celery("think_space", broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+celery_app.conf.update(
+    task_serializer="json",
+    result_serializer="json",
+    accept_content=["json"],
+    result_expires=3600,
+    # Un appel LLM est long : on ne réserve qu'une tâche à la fois par worker
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+)
+
+client = None
+
+# État partagé par tous les workers (limite de débit et disjoncteur) : le
+# rate_limit de Celery est propre à chaque worker et se multiplierait avec
+# leur nombre. Les appels faits directement par l'API (/brainstorm,
+# /brainstorm/stream) gardent leur propre limiteur en mémoire : GROQ_RPM_LIMIT
+# doit tenir compte de la part réservée à ces endpoints.
+limiter_redis = redis.Redis.from_url(os.getenv("REDIS_URL", CELERY_BROKER_URL), decode_responses=True)
+
+# Fenêtre glissante de 60 s : enregistre l'appel et renvoie 0 s'il reste de
+# la place, sinon le nombre de secondes à attendre
+SLIDING_WINDOW_SCRIPT = limiter_redis.register_script("""
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - 60)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], now, ARGV[3])
+    redis.call('EXPIRE', KEYS[1], 61)
+    return '0'
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return tostring(tonumber(oldest[2]) + 60 - now)
+""")
+
+
+class CircuitOpenError(Exception):
+    """Levée quand le disjoncteur partagé refuse un appel vers Groq"""
+
+
+def acquire_rate_slot() -> float:
+    """Réserve un appel dans la fenêtre RPM partagée ; renvoie l'attente nécessaire (0 si accepté)"""
+    wait = SLIDING_WINDOW_SCRIPT(
+        keys=["ratelimit:groq"],
+        args=[time.time(), GROQ_RPM_LIMIT, uuid.uuid4().hex]
+    )
+    return float(wait)
+
+
+def record_upstream_failure():
+    failures = limiter_redis.incr("circuit:groq:failures")
+    limiter_redis.expire("circuit:groq:failures", CIRCUIT_RECOVERY_TIMEOUT)
+    if failures >= CIRCUIT_FAILURE_THRESHOLD:
+        limiter_redis.set("circuit:groq:open", "1", ex=CIRCUIT_RECOVERY_TIMEOUT)
+        logger.warning(" Disjoncteur ouvert après %d échecs consécutifs", failures)
+
+
+def get_client() -> Groq:
+    """Client Groq créé à la première tâche, dans le processus du worker"""
+    global client
+    if client is None:
+        client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+        logger.info(" Client Groq initialisé dans le worker (modèle: %s)", MODEL)
+    return client
+
+
+@celery_app.task(
+    name="brainstorm",
+    bind=True,
+    autoretry_for=(RateLimitError, APIConnectionError, InternalServerError),
+    retry_backoff=True,
+    max_retries=3,
+)
+def brainstorm_task(self, messages):
+    """Appelle Groq avec les messages déjà construits par l'API et renvoie la réponse"""
+    if limiter_redis.exists("circuit:groq:open"):
+        raise CircuitOpenError("Service IA temporairement indisponible, réessaie plus tard.")
+    
+    wait = acquire_rate_slot()
+    if wait > 0:
+        # Remise en file sous le même task_id, comme self.retry(), mais sans
+        # incrémenter request.retries : les tentatives restent réservées aux
+        # erreurs Groq (autoretry_for)
+        signature = self.signature_from_request(self.request, countdown=wait, retries=self.request.retries)
+        signature.apply_async()
+        raise Retry(when=wait, sig=signature)
+    
+    try:
+        completion = get_client().chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            temperature=0.8,
+            max_tokens=1024
+        )
+    except (APIConnectionError, InternalServerError):
+        record_upstream_failure()
+        raise
+    limiter_redis.delete("circuit:groq:failures")
+    return completion.choices[0].message.content
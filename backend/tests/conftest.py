@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Configuration minimale avant l'import de main : clé factice et modèle
+# d'embedding inconnu (cache sémantique désactivé, aucun téléchargement)
+os.environ.setdefault("GROQ_API_KEY", "test-key")
+os.environ.setdefault("EMBEDDING_MODEL", "test/unavailable-model")
+os.environ.pop("REDIS_URL", None)
+os.environ.pop("CELERY_BROKER_URL", None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,170 @@
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from groq import AsyncGroq
+
+import main
+
+
+def completion_body(content):
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": main.MODEL,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+    }
+
+
+def stream_events(parts):
+    events = []
+    for part in parts:
+        chunk = {
+            "id": "chatcmpl-test",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": main.MODEL,
+            "choices": [{"index": 0, "delta": {"content": part}, "finish_reason": None}]
+        }
+        events.append(f"data: {json.dumps(chunk)}\n\n")
+    # Groq joint l'usage au dernier fragment, dans x_groq
+    last = {
+        "id": "chatcmpl-test",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": main.MODEL,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        "x_groq": {"id": "req-test", "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}}
+    }
+    events.append(f"data: {json.dumps(last)}\n\n")
+    events.append("data: [DONE]\n\n")
+    return events
+
+
+class FakeGroq:
+    """Transport HTTP simulant l'API Groq ; enregistre les requêtes reçues"""
+
+    def __init__(self):
+        self.requests = []
+        self.status_code = 200
+        self.headers = {}
+        # Nombre d'appels Groq en cours vus par le limiteur pendant le flux
+        self.active_during_stream = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        payload = json.loads(request.content)
+        self.requests.append(payload)
+        if self.status_code != 200:
+            return httpx.Response(self.status_code, headers=self.headers, json={"error": {"message": "rate limited"}})
+        if payload.get("stream"):
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=self.stream(["Idée ", "#1"]))
+        return httpx.Response(200, json=completion_body(f"Réponse {len(self.requests)}"))
+
+    async def stream(self, parts):
+        for event in stream_events(parts):
+            self.active_during_stream.append(main.rate_limiter._active)
+            yield event.encode()
+
+
+@pytest.fixture
+def groq(monkeypatch):
+    fake = FakeGroq()
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler))
+    monkeypatch.setattr(main, "client", AsyncGroq(api_key="test-key", http_client=http_client, max_retries=0))
+    monkeypatch.setattr(main, "embedder", None)
+    # Primitives asyncio neuves : chaque TestClient tourne dans sa propre boucle
+    monkeypatch.setattr(main, "rate_limiter", main.AdaptiveRateLimiter(main.GROQ_RPM_LIMIT, main.GROQ_MAX_CONCURRENCY))
+    monkeypatch.setattr(main, "circuit_breaker", main.CircuitBreaker(
+        main.CIRCUIT_FAILURE_THRESHOLD, main.CIRCUIT_RECOVERY_TIMEOUT, main.circuit_breaker.failure_types
+    ))
+    main.conversations.clear()
+    main.session_locks.clear()
+    return fake
+
+
+@pytest.fixture
+def api(groq):
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def test_brainstorm_keeps_conversation_history(api, groq):
+    first = api.post("/brainstorm", json={"prompt": "Une idée pour l'agriculture"})
+    assert first.status_code == 200
+    session_id = first.json()["session_id"]
+    assert first.json()["response"] == "Réponse 1"
+
+    second = api.post("/brainstorm", json={"prompt": "Approfondis la première", "session_id": session_id})
+    assert second.status_code == 200
+    assert second.json()["response"] == "Réponse 2"
+
+    sent = groq.requests[-1]["messages"]
+    assert sent[0] == main.SYSTEM_MESSAGE
+    assert [m["role"] for m in sent[1:]] == ["user", "assistant", "user"]
+    assert sent[2]["content"] == "Réponse 1"
+
+
+def test_brainstorm_stream_sends_deltas_and_records_reply(api, groq):
+    response = api.post("/brainstorm/stream", json={"prompt": "Une idée", "session_id": "s1"})
+    assert response.status_code == 200
+
+    events = [line[len("data: "):] for line in response.text.split("\n\n") if line.startswith("data: ")]
+    assert json.loads(events[0]) == {"session_id": "s1"}
+    assert [json.loads(e)["delta"] for e in events[1:-1]] == ["Idée ", "#1"]
+    assert events[-1] == "[DONE]"
+
+    assert main.conversations["s1"][-1] == {"role": "assistant", "content": "Idée #1"}
+
+
+def test_brainstorm_stream_holds_rate_limit_slot_until_stream_ends(api, groq, caplog):
+    caplog.set_level("INFO", logger="main")
+
+    response = api.post("/brainstorm/stream", json={"prompt": "Une idée"})
+
+    assert response.status_code == 200
+    assert set(groq.active_during_stream) == {1}
+    assert main.rate_limiter._active == 0
+    assert "Tokens prompt: 10" in caplog.text
+
+
+def test_brainstorm_maps_upstream_rate_limit_to_429(api, groq):
+    groq.status_code = 429
+    groq.headers = {"retry-after": "0"}
+
+    response = api.post("/brainstorm", json={"prompt": "Une idée"})
+
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "0"
+    assert main.rate_limiter.concurrency == main.GROQ_MAX_CONCURRENCY / 2
+
+
+def test_task_result_maps_worker_circuit_open_to_503(api, monkeypatch):
+    import tasks
+
+    class FailedResult:
+        state = "FAILURE"
+        result = tasks.CircuitOpenError("Service IA temporairement indisponible")
+
+    monkeypatch.setattr(main, "CELERY_ENABLED", True)
+    monkeypatch.setattr(main, "AsyncResult", lambda task_id, app: FailedResult())
+
+    response = api.get("/brainstorm/task-1")
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == str(main.CIRCUIT_RECOVERY_TIMEOUT)
+
+
+def test_health_check_reports_in_memory_sessions(api, groq):
+    api.post("/brainstorm", json={"prompt": "Une idée", "session_id": "s1"})
+
+    response = api.get("/")
+
+    assert response.status_code == 200
+    assert response.json()["active_sessions"] == 1
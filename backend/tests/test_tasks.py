@@ -0,0 +1,26 @@
+from unittest import mock
+
+import pytest
+from celery.exceptions import Retry
+
+import tasks
+
+
+def test_full_rate_window_requeues_without_using_retries():
+    sent = []
+    messages = [{"role": "user", "content": "Une idée"}]
+
+    with mock.patch.object(tasks.limiter_redis, "exists", return_value=0), \
+            mock.patch.object(tasks, "acquire_rate_slot", return_value=12.0), \
+            mock.patch("celery.canvas.Signature.apply_async", lambda self, *a, **k: sent.append(self)):
+        tasks.brainstorm_task.push_request(id="task-1", retries=3, args=[messages], kwargs={})
+        try:
+            with pytest.raises(Retry):
+                tasks.brainstorm_task.run(messages)
+        finally:
+            tasks.brainstorm_task.pop_request()
+
+    assert sent[0].options["task_id"] == "task-1"
+    assert sent[0].options["countdown"] == 12.0
+    # Le compteur des tentatives d'erreur n'est pas incrémenté
+    assert sent[0].options["retries"] == 3